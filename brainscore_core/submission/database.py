@@ -1,9 +1,13 @@
+import functools
 import json
 import logging
+import numpy as np
+import os
 from datetime import datetime
-from peewee import PostgresqlDatabase, SqliteDatabase, DoesNotExist
+from peewee import SqliteDatabase, DoesNotExist, Case, chunked
+from playhouse.pool import PooledPostgresqlDatabase
 from pybtex.database.input import bibtex
-from typing import List, Union
+from typing import List, Union, Dict, Tuple
 
 from brainscore_core.benchmarks import Benchmark
 from brainscore_core.metrics import Score as ScoreObject
@@ -13,14 +17,24 @@ from brainscore_core.submission.utils import get_secret
 
 logger = logging.getLogger(__name__)
 
+SCORE_PENDING_COMMENT = 'pending: not yet run'
+""" comment of score entries that were created ahead of scoring, replaced once the model is run on the benchmark """
+
 
 def connect_db(db_secret):
+    """
+    Connect to the database referenced by `db_secret`.
+    Postgres connections are pooled, with a pool size set by the `BS_DB_POOL` environment variable (default 8),
+    so that callers can check out a connection with `database_proxy.connection_context()` and return it afterwards.
+    """
+    _cached_reference_from_bibtex.cache_clear()  # cached references belong to the previous database
     if 'sqlite3' not in db_secret:
         secret = get_secret(db_secret)
         db_configs = json.loads(secret)
-        postgres = PostgresqlDatabase(db_configs['dbInstanceIdentifier'],
-                                      **{'host': db_configs['host'], 'port': 5432,
-                                         'user': db_configs['username'], 'password': db_configs['password']})
+        postgres = PooledPostgresqlDatabase(db_configs['dbInstanceIdentifier'],
+                                            max_connections=int(os.getenv('BS_DB_POOL', 8)), stale_timeout=300,
+                                            **{'host': db_configs['host'], 'port': 5432,
+                                               'user': db_configs['username'], 'password': db_configs['password']})
         database_proxy.initialize(postgres)
         database_proxy.connect()
     else:
@@ -66,15 +80,68 @@ def submissionentry_from_meta(jenkins_id: int, user_id: int, model_type: str) ->
 
 
 def public_model_identifiers(domain: str) -> List[str]:
-    entries = Model.select().where(Model.public & (Model.domain == domain))
-    identifiers = [entry.name for entry in entries]
-    return identifiers
+    query = Model.select(Model.name).where(Model.public & (Model.domain == domain))
+    return _first_column(query)
 
 
 def public_benchmark_identifiers(domain: str) -> List[str]:
-    entries = BenchmarkType.select().where(BenchmarkType.visible & (BenchmarkType.domain == domain))
-    identifiers = [entry.identifier for entry in entries]
-    return identifiers
+    query = BenchmarkType.select(BenchmarkType.identifier).where(
+        BenchmarkType.visible & (BenchmarkType.domain == domain))
+    return _first_column(query)
+
+
+def _first_column(query) -> list:
+    """
+    Run the `query` on the raw database cursor and return the first column of all rows,
+    without instantiating a peewee result object per row.
+    """
+    cursor = database_proxy.execute(query)
+    return [row[0] for row in cursor.fetchall()]
+
+
+def existing_score_entries(model_identifiers: List[str],
+                           benchmark_identifiers: List[str]) -> Dict[Tuple[str, int], Score]:
+    """
+    Retrieve all score entries of the given models on the given benchmarks in a single query.
+    :return: a dictionary mapping `(model identifier, benchmark instance id)` to the corresponding score entry
+    """
+    entries = (Score.select(Score, Model.id, Model.name)
+               .join(Model, on=(Score.model == Model.id))
+               .switch(Score)
+               .join(BenchmarkInstance, on=(Score.benchmark == BenchmarkInstance.id))
+               .where(Model.name.in_(model_identifiers) & BenchmarkInstance.benchmark.in_(benchmark_identifiers))
+               .order_by(Score.id))
+    score_entries = {}
+    for entry in entries:
+        score_entries.setdefault((entry.model.name, entry.benchmark_id), entry)
+    return score_entries
+
+
+def seed_score_entries(model_identifiers: List[str],
+                       benchmark_entry: BenchmarkInstance) -> Dict[Tuple[str, int], Score]:
+    """
+    Create the score entries of all models in `model_identifiers` that already have a model entry
+    on the `benchmark_entry`, unless a score entry exists already.
+    Missing entries are inserted with a single statement per batch rather than one `get_or_create` per model,
+    and are marked with the :data:`SCORE_PENDING_COMMENT` so that they can be told apart from entries that were run.
+    :return: the newly created score entries, keyed like :func:`existing_score_entries`
+    """
+    existing_entries = existing_score_entries(model_identifiers, [benchmark_entry.benchmark_type_id])
+    model_entries = {}
+    for model_entry in Model.select(Model.id, Model.name).where(Model.name.in_(model_identifiers)).order_by(Model.id):
+        model_entries.setdefault(model_entry.name, model_entry)  # only one score entry per model identifier
+    missing_models = [model_entry for model_identifier, model_entry in model_entries.items()
+                      if (model_identifier, benchmark_entry.id) not in existing_entries]
+    if not missing_models:
+        return {}
+    with database_proxy.atomic():
+        for batch in chunked(missing_models, 100):
+            Score.insert_many([{Score.model: model_entry.id, Score.benchmark: benchmark_entry.id,
+                                Score.comment: SCORE_PENDING_COMMENT}
+                               for model_entry in batch]).execute()
+    created_entries = existing_score_entries([model_entry.name for model_entry in missing_models],
+                                             [benchmark_entry.benchmark_type_id])
+    return {key: entry for key, entry in created_entries.items() if key[1] == benchmark_entry.id}
 
 
 def modelentry_from_model(model_identifier: str, public: bool, competition: Union[None, str],
@@ -127,6 +194,22 @@ def benchmarkinstance_from_benchmark(benchmark: Benchmark, domain: str) -> Bench
 
 
 def reference_from_bibtex(bibtex_string: str) -> Union[Reference, None]:
+    """
+    Parse the `bibtex_string` and retrieve or create the corresponding reference entry.
+    Successful lookups are cached per bibtex string until the next call to :func:`connect_db`, failed ones are
+    retried on the next call.
+    The cache is not transaction-aware: if the transaction that created a reference is rolled back, the cached
+    entry points to a row that no longer exists, so call `_cached_reference_from_bibtex.cache_clear()` after a rollback.
+    """
+    try:
+        return _cached_reference_from_bibtex(bibtex_string)
+    except Exception:
+        logger.exception('Could not load reference from bibtex string')
+        return None
+
+
+@functools.lru_cache(maxsize=1024)
+def _cached_reference_from_bibtex(bibtex_string: str) -> Reference:
     def parse_bib(bibtex_str):
         bib_parser = bibtex.Parser()
         entry = bib_parser.parse_string(bibtex_str)
@@ -135,19 +218,15 @@ def reference_from_bibtex(bibtex_string: str) -> Union[Reference, None]:
         entry = list(entry.values())[0]
         return entry
 
-    try:
-        entry = parse_bib(bibtex_string)
-        ref, created = Reference.get_or_create(url=entry.fields['url'],
-                                               defaults={'bibtex': bibtex_string,
-                                                         'author': entry.persons["author"][0].last()[0],
-                                                         'year': entry.fields['year']})
-        return ref
-    except Exception:
-        logger.exception('Could not load reference from bibtex string')
-        return None
+    entry = parse_bib(bibtex_string)
+    ref, created = Reference.get_or_create(url=entry.fields['url'],
+                                           defaults={'bibtex': bibtex_string,
+                                                     'author': entry.persons["author"][0].last()[0],
+                                                     'year': entry.fields['year']})
+    return ref
 
 
-def update_score(score: ScoreObject, entry: Score):
+def update_score(score: ScoreObject, entry: Score, save: bool = True):
     if 'ceiling' not in score.attrs:  # many engineering benchmarks do not have a primate ceiling
         # only store raw (unceiled) value
         entry.score_raw = _retrieve_score_center(score)
@@ -157,7 +236,25 @@ def update_score(score: ScoreObject, entry: Score):
         entry.score_ceiled = _retrieve_score_center(score)
     entry.error = _retrieve_score_error(score)
     logger.debug(f"updating raw score: {entry.score_raw}, ceiled score: {entry.score_ceiled}, error: {entry.error}")
-    entry.save()
+    if save:
+        entry.save()
+
+
+def bulk_update_scores(entries: List[Score], batch_size: int = 200):
+    """
+    Write the timestamps, values, and comments of all score `entries` to the database in a single transaction,
+    with one `UPDATE` statement per batch of entries.
+    """
+    fields = [Score.start_timestamp, Score.end_timestamp, Score.score_raw, Score.score_ceiled, Score.error,
+              Score.comment]
+    with database_proxy.atomic():
+        for batch in chunked(entries, batch_size):
+            # Default to the column itself (never reached due to the `where` clause) so that postgres can infer the
+            # column type even if all values of a batch are NULL. `Score.bulk_update` does not allow for this.
+            update = {field: Case(Score.id, [(entry.id, field.db_value(getattr(entry, field.name)))
+                                             for entry in batch], field)
+                      for field in fields}
+            Score.update(update).where(Score.id.in_([entry.id for entry in batch])).execute()
 
 
 def _retrieve_score_center(score: ScoreObject) -> float:
@@ -166,7 +263,7 @@ def _retrieve_score_center(score: ScoreObject) -> float:
     i.e. a single scalar in the score object versus an aggregation dimension.
     """
     if hasattr(score, 'aggregation'):
-        return score.sel(aggregation='center').item()
+        return _retrieve_aggregation(score, 'center')
     return score.item()
 
 
@@ -177,7 +274,17 @@ def _retrieve_score_error(score: ScoreObject) -> Union[float, None]:
     Returns None if no error was found
     """
     if hasattr(score, 'aggregation'):
-        return score.sel(aggregation='error').item()
+        return _retrieve_aggregation(score, 'error')
     if 'error' in score.attrs:
         return score.attrs['error']
     return None
+
+
+def _retrieve_aggregation(score: ScoreObject, aggregation: str) -> float:
+    """
+    Index the `aggregation` value by position in the underlying array.
+    This avoids `score.sel` which, for Score objects, also applies the selection to all raw scores in the attributes.
+    """
+    index = list(score['aggregation'].values).index(aggregation)
+    values = np.take(np.asarray(score.values), index, axis=score.dims.index('aggregation'))
+    return values.item()
@@ -1,25 +1,37 @@
 """
 Process plugin submissions (data, metrics, benchmarks, models) and score models on benchmarks.
 """
+import functools
 import traceback
 import logging
+import multiprocessing
 from abc import ABC
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 import os
+import queue
 import random
 import requests
 from requests.auth import HTTPBasicAuth
 import string
-from typing import List, Union, Dict
+import threading
+import time
+from typing import Callable, Iterator, List, NamedTuple, Union, Dict, Set, Tuple
 
 from brainscore_core import Benchmark, Score
 from brainscore_core.submission import database_models
+from brainscore_core.submission.database_models import database_proxy
+from brainscore_core.submission.utils import ArtifactCache, artifact_cache_preference
 from brainscore_core.submission.database import connect_db, modelentry_from_model, \
-    submissionentry_from_meta, benchmarkinstance_from_benchmark, update_score, \
-    public_model_identifiers, public_benchmark_identifiers, uid_from_email, email_from_uid
+    submissionentry_from_meta, benchmarkinstance_from_benchmark, update_score, bulk_update_scores, \
+    existing_score_entries, seed_score_entries, public_model_identifiers, public_benchmark_identifiers, \
+    uid_from_email, email_from_uid
 
 logger = logging.getLogger(__name__)
 
+_COMMENT_MAX_LENGTH = database_models.Score.comment.max_length
+
 
 class UserManager:
     """
@@ -77,12 +89,53 @@ class DomainPlugins(ABC):
     def score(self, model_identifier: str, benchmark_identifier: str) -> Score:
         raise NotImplementedError()
 
+    def score_loaded(self, model, benchmark: Benchmark, model_identifier: str, benchmark_identifier: str) -> Score:
+        """
+        Score an already loaded `model` on an already loaded `benchmark`.
+        Plugins can override this method to avoid loading model and benchmark again,
+        by default it defers to :meth:`score`.
+        """
+        return self.score(model_identifier=model_identifier, benchmark_identifier=benchmark_identifier)
+
 
 class RunScoringEndpoint:
     ALL_PUBLIC = "all_public"  """ key to reference models or benchmarks to all public entries """
+    PUBLIC_IDENTIFIERS_TTL = 60  # seconds for which public model and benchmark identifiers are cached
+    SCORE_UPDATES_BATCH_SIZE = 10  # scored pairs after which pending score updates are written at the latest
+    MAX_LOADED_BENCHMARKS = 8  # benchmarks kept loaded for later models, any others are re-loaded for every model
 
-    def __init__(self, domain_plugins: DomainPlugins, db_secret: str):
+    def __init__(self, domain_plugins: DomainPlugins, db_secret: str, max_workers: Union[None, int] = None,
+                 prefetch_pairs: Union[None, int] = None):
+        """
+        :param max_workers: number of processes to score (model, benchmark) pairs in parallel.
+            Defaults to the `BS_SCORING_WORKERS` environment variable, or 1 (score sequentially in this process).
+            When scoring on GPUs, set this to the number of devices in `CUDA_VISIBLE_DEVICES`.
+        :param prefetch_pairs: when scoring sequentially, how many upcoming pairs a background thread loads ahead of
+            the pair that is currently being scored. Defaults to the `BS_PREFETCH_PAIRS` environment variable, or 0
+            (load every pair in the main thread right before scoring it).
+            Prefetching keeps the models of upcoming pairs in memory next to the one being scored and loads models
+            outside the main thread, so only enable it for models that fit into memory several times over and that
+            do not rely on thread-local state such as the default graph in tensorflow 1.
+        """
         self.domain_plugins = domain_plugins
+        self.db_secret = db_secret
+        self.max_workers = max_workers if max_workers is not None else int(os.getenv('BS_SCORING_WORKERS', 1))
+        self.prefetch_pairs = prefetch_pairs if prefetch_pairs is not None \
+            else int(os.getenv('BS_PREFETCH_PAIRS', 0))
+        self._entry_lock = nullcontext()  # replaced by a lock shared across processes when scoring in parallel
+        self._existing_scores: Dict[Tuple[str, int], database_models.Score] = {}
+        # score entries are created in bulk for all models of the current call when a benchmark is first resolved
+        self._scoring_models: List[str] = []
+        self._benchmark_entries: Dict[str, database_models.BenchmarkInstance] = {}
+        self._seeded_scores: Set[Tuple[str, int]] = set()
+        # written in batches by `_flush_score_updates`, at the latest whenever the model changes
+        self._pending_score_updates: List[database_models.Score] = []
+        # Pairs are scored model by model, so we only hold on to the most recent model
+        # and keep up to `MAX_LOADED_BENCHMARKS` benchmarks loaded while later models still need them.
+        self._loaded_model: Union[None, Tuple[str, object]] = None
+        self._loaded_benchmarks: Dict[str, Benchmark] = {}
+        # opt-in on-disk cache to skip loading models and benchmarks from source in subsequent processes
+        self._artifact_cache = ArtifactCache() if artifact_cache_preference() else None
         logger.info(f"Connecting to db using secret '{db_secret}'")
         connect_db(db_secret=db_secret)
 
@@ -100,86 +153,337 @@ class RunScoringEndpoint:
         """
         # setup entry for this entire submission
         submission_entry = submissionentry_from_meta(jenkins_id=jenkins_id, user_id=user_id, model_type=model_type)
-        entire_submission_successful = True
 
         # resolve settings
+        ttl_bucket = int(time.time() // self.PUBLIC_IDENTIFIERS_TTL)
         if models == self.ALL_PUBLIC:
-            models = public_model_identifiers(domain)
+            models = _cached_public_model_identifiers(self.db_secret, domain, ttl_bucket)
         if benchmarks == self.ALL_PUBLIC:
-            benchmarks = public_benchmark_identifiers(domain)
+            benchmarks = _cached_public_benchmark_identifiers(self.db_secret, domain, ttl_bucket)
 
         logger.info(f"Models: {models}")
         logger.info(f"Benchmarks: {benchmarks}")
 
-        for model_identifier in models:
-            for benchmark_identifier in benchmarks:
-                logger.debug(f"Scoring {model_identifier} on {benchmark_identifier}")
-                # TODO: I am worried about reloading models inside the loop. E.g. a keras model where layer names are
-                #  automatic and will be consecutive from previous layers
-                #  (e.g. on first load layers are [1, 2, 3], on second load layers are [4, 5, 6])
-                #  which can lead to issues with layer assignment
+        # retrieve existing scores at once rather than querying for every pair
+        self._existing_scores = existing_score_entries(model_identifiers=models, benchmark_identifiers=benchmarks)
+        self._scoring_models = list(models)
+        pairs = [(model_identifier, benchmark_identifier)
+                 for model_identifier in models for benchmark_identifier in benchmarks]
+        run_kwargs = dict(submission_entry=submission_entry, domain=domain, public=public, competition=competition)
+        entire_submission_successful = False  # in case scoring raises unexpectedly
+        try:
+            if self.max_workers > 1 and len(pairs) > 1:
+                entire_submission_successful = self._score_pairs_parallel(pairs, **run_kwargs)
+            else:
+                entire_submission_successful = self._score_pairs_sequential(pairs, **run_kwargs)
+        finally:
+            try:
+                self._flush_score_updates()
+            except Exception as e:
+                entire_submission_successful = False
+                logging.error(f'Could not store {len(self._pending_score_updates)} scores because of {e}',
+                              exc_info=True)
+
+            self._pending_score_updates = []
+            self._loaded_model = None
+            self._loaded_benchmarks.clear()
+            self._scoring_models = []
+            self._benchmark_entries.clear()
+            self._seeded_scores.clear()
+
+            # finalize status of submission
+            submission_status = 'successful' if entire_submission_successful else 'failure'
+            submission_entry.status = submission_status
+            logger.info(f'Submission is stored as {submission_status}')
+            submission_entry.save()
+
+    @staticmethod
+    def refresh_public_lists():
+        """ Discard the cached public model and benchmark identifiers, e.g. after changing public entries. """
+        _cached_public_model_identifiers.cache_clear()
+        _cached_public_benchmark_identifiers.cache_clear()
+
+    def _score_pairs_sequential(self, pairs: List[Tuple[str, str]], **run_kwargs) -> bool:
+        """
+        Score the (model, benchmark) `pairs` one after the other in this process.
+        If `prefetch_pairs` is set, a background thread loads the models and benchmarks of upcoming pairs (and
+        creates their database entries) while the current pair is being scored, so that loading overlaps with scoring.
+        Scores are written whenever the model changes and every `SCORE_UPDATES_BATCH_SIZE` pairs, so that an
+        interrupted run keeps the scores computed so far.
+        """
+        entire_submission_successful = True
+        prepared_pairs = self._prepare_pairs(pairs, **run_kwargs)
+        if self.prefetch_pairs > 0:
+            prepared_pairs = _prefetch(prepared_pairs, num_items=self.prefetch_pairs)
+        previous_model_identifier = None
+        for (model_identifier, benchmark_identifier), prepared_pair, error in prepared_pairs:
+            if model_identifier != previous_model_identifier or \
+                    len(self._pending_score_updates) >= self.SCORE_UPDATES_BATCH_SIZE:
+                self._try_flush_score_updates()
+            previous_model_identifier = model_identifier
+            logger.debug(f"Scoring {model_identifier} on {benchmark_identifier}")
+            try:
+                if error is not None:
+                    raise error
+                if prepared_pair is not None:  # pair has not been scored yet
+                    self._run_pair(model_identifier=model_identifier, benchmark_identifier=benchmark_identifier,
+                                   prepared_pair=prepared_pair)
+            except Exception as e:
+                entire_submission_successful = False
+                logging.error(
+                    f'Could not run model {model_identifier} on benchmark {benchmark_identifier} because of {e}',
+                    exc_info=True)
+        return entire_submission_successful
+
+    def _prepare_pairs(self, pairs: List[Tuple[str, str]], **run_kwargs) \
+            -> Iterator[Tuple[Tuple[str, str], Union[None, '_PreparedPair'], Union[None, Exception]]]:
+        """
+        Lazily prepare the `pairs`, yielding `(pair, prepared pair or None if already scored, error or None)`.
+        """
+        # bind everything that is constant across pairs once, rather than re-assembling it for every pair
+        prepare_pair = functools.partial(self._prepare_pair, **run_kwargs)
+        connection_context = database_proxy.connection_context
+        for model_identifier, benchmark_identifier in pairs:
+            # TODO: I am worried about reloading models inside the loop. E.g. a keras model where layer names are
+            #  automatic and will be consecutive from previous layers
+            #  (e.g. on first load layers are [1, 2, 3], on second load layers are [4, 5, 6])
+            #  which can lead to issues with layer assignment
+            prepared_pair, error = None, None
+            try:
+                with connection_context():
+                    prepared_pair = prepare_pair(model_identifier=model_identifier,
+                                                 benchmark_identifier=benchmark_identifier)
+            except Exception as e:
+                error = e
+            yield (model_identifier, benchmark_identifier), prepared_pair, error
+
+    def _score_pairs_parallel(self, pairs: List[Tuple[str, str]], **run_kwargs) -> bool:
+        """
+        Score the (model, benchmark) `pairs` in a pool of `max_workers` processes.
+        Every worker process holds its own endpoint with its own database connection, and, since models are loaded
+        in separate processes, framework-global state such as automatic keras layer names does not leak across them.
+        Creation of model, benchmark, and score entries is serialized across workers so that two workers scoring the
+        same model do not both create a database entry for it.
+        Workers are spawned rather than forked so that they neither share this process' database connection
+        nor inherit an already initialized GPU context.
+        """
+        num_workers = min(self.max_workers, len(pairs))
+        logger.info(f"Scoring {len(pairs)} pairs with {num_workers} workers")
+        entire_submission_successful = True
+        mp_context = multiprocessing.get_context('spawn')
+        entry_lock = mp_context.Lock()
+        # hand every worker its own device, if multiple GPUs are available
+        devices = [device for device in os.getenv('CUDA_VISIBLE_DEVICES', '').split(',') if device.strip()]
+        worker_devices = None
+        if len(devices) > 1:
+            worker_devices = mp_context.Queue()
+            for worker_number in range(num_workers):
+                worker_devices.put(devices[worker_number % len(devices)])
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=mp_context,
+                                 initializer=_init_scoring_worker,
+                                 initargs=(self.domain_plugins, self.db_secret, entry_lock,
+                                           self._existing_scores, worker_devices)) as executor:
+            futures = {executor.submit(_score_in_worker, model_identifier=model_identifier,
+                                       benchmark_identifier=benchmark_identifier, **run_kwargs):
+                           (model_identifier, benchmark_identifier)
+                       for model_identifier, benchmark_identifier in pairs}
+            for future in as_completed(futures):
+                model_identifier, benchmark_identifier = futures[future]
                 try:
-                    self._score_model_on_benchmark(model_identifier=model_identifier,
-                                                   benchmark_identifier=benchmark_identifier,
-                                                   submission_entry=submission_entry, domain=domain,
-                                                   public=public, competition=competition)
+                    future.result()
                 except Exception as e:
                     entire_submission_successful = False
                     logging.error(
                         f'Could not run model {model_identifier} on benchmark {benchmark_identifier} because of {e}',
                         exc_info=True)
-
-        # finalize status of submission
-        submission_status = 'successful' if entire_submission_successful else 'failure'
-        submission_entry.status = submission_status
-        logger.info(f'Submission is stored as {submission_status}')
-        submission_entry.save()
+        return entire_submission_successful
 
     def _score_model_on_benchmark(self, model_identifier: str, benchmark_identifier: str,
                                   submission_entry: database_models.Submission, domain: str,
                                   public: bool, competition: Union[None, str]):
-        # TODO: the following is somewhat ugly because we're afterwards loading model and benchmark again
-        #  in the `score` method.
-        logger.info(f'Model database entry')
-        model = self.domain_plugins.load_model(model_identifier)
-        model_entry = modelentry_from_model(model_identifier=model_identifier, domain=domain,
-                                            submission=submission_entry, public=public, competition=competition,
-                                            bibtex=model.bibtex if hasattr(model, 'bibtex') else None)
-
-        logger.info(f'Benchmark database entry')
-        benchmark = self.domain_plugins.load_benchmark(benchmark_identifier)
-        benchmark_entry = benchmarkinstance_from_benchmark(benchmark, domain=domain)
-
-        # Check if the model is already scored on the benchmark
-        start_timestamp = datetime.now()
-        score_entry, created = database_models.Score.get_or_create(benchmark=benchmark_entry, model=model_entry,
-                                                                   defaults={'start_timestamp': start_timestamp, })
+        prepared_pair = self._prepare_pair(model_identifier=model_identifier,
+                                           benchmark_identifier=benchmark_identifier,
+                                           submission_entry=submission_entry, domain=domain,
+                                           public=public, competition=competition)
+        if prepared_pair is not None:
+            self._run_pair(model_identifier=model_identifier, benchmark_identifier=benchmark_identifier,
+                           prepared_pair=prepared_pair)
+
+    def _prepare_pair(self, model_identifier: str, benchmark_identifier: str,
+                      submission_entry: database_models.Submission, domain: str,
+                      public: bool, competition: Union[None, str]) -> Union[None, '_PreparedPair']:
+        """
+        Load model and benchmark and retrieve or create their database entries as well as the score entry.
+        :return: None if the model has already been scored on the benchmark
+        """
+        benchmark = self._load_benchmark(benchmark_identifier, model_identifier=model_identifier)
+        benchmark_entry = self._benchmark_entry(benchmark_identifier, benchmark, domain=domain)
+
+        # Check if the model is already scored on the benchmark, before spending time on loading the model
+        score_key = (model_identifier, benchmark_entry.id)
+        score_entry = self._existing_scores.get(score_key)
+        created = score_key in self._seeded_scores
+        if score_entry is None or score_entry.score_raw is None:
+            model = self._load_model(model_identifier)
+            with self._entry_lock:
+                logger.info(f'Model database entry')
+                model_entry = modelentry_from_model(model_identifier=model_identifier, domain=domain,
+                                                    submission=submission_entry, public=public,
+                                                    competition=competition,
+                                                    bibtex=model.bibtex if hasattr(model, 'bibtex') else None)
+                if score_entry is None:
+                    score_entry, created = database_models.Score.get_or_create(
+                        benchmark=benchmark_entry, model=model_entry)
         if not created and score_entry.score_raw is not None:
             logger.warning(f'A score for model {model_identifier} and benchmark {benchmark_identifier} already exists')
-            return
+            return None
 
         if not created:  # previous score entry exists, but no score was stored
-            score_entry.start_timestamp = datetime.now()
             score_entry.comment = None
-            score_entry.save()
+            score_entry.save(only=[database_models.Score.comment])
             logger.warning('A score entry exists but does not have a score value, so we run it again')
+        return _PreparedPair(model=model, benchmark=benchmark, score_entry=score_entry)
 
+    def _run_pair(self, model_identifier: str, benchmark_identifier: str, prepared_pair: '_PreparedPair'):
+        score_entry = prepared_pair.score_entry
+        score_entry.start_timestamp = datetime.now()  # the pair might have been prepared well before scoring starts
+        score_entry.comment = None  # entries seeded ahead of scoring are marked as pending
         # run actual scoring mechanism
         try:
-            score_result = self.domain_plugins.score(
+            score_result = self.domain_plugins.score_loaded(
+                model=prepared_pair.model, benchmark=prepared_pair.benchmark,
                 model_identifier=model_identifier, benchmark_identifier=benchmark_identifier)
             score_entry.end_timestamp = datetime.now()
             # store in database
             logger.info(f'Score from running {model_identifier} on {benchmark_identifier}: {score_result}')
-            update_score(score_result, score_entry)
+            update_score(score_result, score_entry, save=False)
         except Exception as e:
-            stacktrace = traceback.format_exc()
-            error_message = f'Model {model_identifier} could not run on benchmark {benchmark_identifier}: ' \
-                            f'{repr(e)}. \n{stacktrace}'
-            error_message = shorten_text(error_message, max_length=database_models.Score.comment.max_length)
+            error_message = f'Model {model_identifier} could not run on benchmark {benchmark_identifier}: {repr(e)}.'
+            if logger.isEnabledFor(logging.DEBUG):  # otherwise, the full stack is only logged by the caller
+                error_message += f' \n{traceback.format_exc()}'
+            error_message = shorten_text(error_message, max_length=_COMMENT_MAX_LENGTH)
             score_entry.comment = error_message
-            score_entry.save()
             raise e
+        finally:
+            self._pending_score_updates.append(score_entry)
+
+    def _flush_score_updates(self):
+        if self._pending_score_updates:
+            bulk_update_scores(self._pending_score_updates)
+            self._pending_score_updates = []
+
+    def _try_flush_score_updates(self):
+        """ Flush pending score updates while scoring, keeping them for the next flush if they cannot be written """
+        try:
+            with database_proxy.connection_context():
+                self._flush_score_updates()
+        except Exception as e:
+            logging.error(f'Could not store {len(self._pending_score_updates)} scores because of {e}, '
+                          f'will retry with the next batch', exc_info=True)
+
+    def _load_model(self, model_identifier: str):
+        if self._loaded_model is None or self._loaded_model[0] != model_identifier:
+            self._loaded_model = None  # release the previous model before loading the next one
+            model = self._load_artifact(self.domain_plugins.load_model, model_identifier)
+            self._loaded_model = (model_identifier, model)
+        return self._loaded_model[1]
+
+    def _load_benchmark(self, benchmark_identifier: str, model_identifier: str) -> Benchmark:
+        if self._scoring_models and model_identifier == self._scoring_models[-1]:
+            # no later model needs this benchmark, release it once the last model has been scored on it
+            benchmark = self._loaded_benchmarks.pop(benchmark_identifier, None)
+            if benchmark is None:
+                benchmark = self._load_artifact(self.domain_plugins.load_benchmark, benchmark_identifier)
+            return benchmark
+        if benchmark_identifier not in self._loaded_benchmarks:
+            benchmark = self._load_artifact(self.domain_plugins.load_benchmark, benchmark_identifier)
+            # Pairs come in the same benchmark order for every model, so once the cache is full we keep the
+            # benchmarks that are already loaded rather than evicting them (which would never hit).
+            if len(self._loaded_benchmarks) >= self.MAX_LOADED_BENCHMARKS:
+                return benchmark
+            self._loaded_benchmarks[benchmark_identifier] = benchmark
+        return self._loaded_benchmarks[benchmark_identifier]
+
+    def _benchmark_entry(self, benchmark_identifier: str, benchmark: Benchmark,
+                         domain: str) -> database_models.BenchmarkInstance:
+        if benchmark_identifier not in self._benchmark_entries:
+            with self._entry_lock:
+                logger.info(f'Benchmark database entry')
+                benchmark_entry = benchmarkinstance_from_benchmark(benchmark, domain=domain)
+                if self._scoring_models:
+                    seeded_scores = seed_score_entries(self._scoring_models, benchmark_entry)
+                    self._existing_scores.update(seeded_scores)
+                    self._seeded_scores.update(seeded_scores.keys())
+            self._benchmark_entries[benchmark_identifier] = benchmark_entry
+        return self._benchmark_entries[benchmark_identifier]
+
+    def _load_artifact(self, loader: Callable[[str], object], identifier: str):
+        if self._artifact_cache is None:
+            return loader(identifier)
+        return self._artifact_cache.load(loader, identifier)
+
+
+class _PreparedPair(NamedTuple):
+    """ a (model, benchmark) pair that is loaded and ready to be scored """
+    model: object
+    benchmark: Benchmark
+    score_entry: database_models.Score
+
+
+def _prefetch(iterator: Iterator, num_items: int) -> Iterator:
+    """
+    Consume the `iterator` in a background thread that stays up to `num_items` ahead of the caller.
+    """
+    items = queue.Queue(maxsize=num_items)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterator:
+                items.put(item)
+        finally:
+            items.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    return iter(items.get, done)
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_public_model_identifiers(db_secret: str, domain: str, ttl_bucket: int) -> Tuple[str, ...]:
+    """ :param ttl_bucket: changes every `RunScoringEndpoint.PUBLIC_IDENTIFIERS_TTL` seconds to invalidate the cache """
+    return tuple(public_model_identifiers(domain))
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_public_benchmark_identifiers(db_secret: str, domain: str, ttl_bucket: int) -> Tuple[str, ...]:
+    """ :param ttl_bucket: changes every `RunScoringEndpoint.PUBLIC_IDENTIFIERS_TTL` seconds to invalidate the cache """
+    return tuple(public_benchmark_identifiers(domain))
+
+
+_worker_endpoint: Union[None, RunScoringEndpoint] = None
+""" endpoint of the current scoring worker process, set by :func:`_init_scoring_worker` """
+
+
+def _init_scoring_worker(domain_plugins: DomainPlugins, db_secret: str, entry_lock,
+                         existing_scores: Dict[Tuple[str, int], database_models.Score], worker_devices):
+    """
+    Set up a worker process of :meth:`RunScoringEndpoint._score_pairs_parallel`: connect to the database and,
+    if `worker_devices` is given, pin this worker to the next GPU in that queue.
+    """
+    global _worker_endpoint
+    if worker_devices is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = worker_devices.get()
+    _worker_endpoint = RunScoringEndpoint(domain_plugins=domain_plugins, db_secret=db_secret, max_workers=1)
+    _worker_endpoint._entry_lock = entry_lock
+    _worker_endpoint._existing_scores = existing_scores
+
+
+def _score_in_worker(**kwargs):
+    with database_proxy.connection_context():
+        try:
+            _worker_endpoint._score_model_on_benchmark(**kwargs)
+        finally:
+            _worker_endpoint._flush_score_updates()
 
 
 def get_email_from_uid(uid: int) -> str:
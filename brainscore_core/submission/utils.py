@@ -1,8 +1,17 @@
 import boto3
+import hashlib
+import inspect
 import logging
+import os
+import pickle
+import sys
+from pathlib import Path
+from typing import Callable, Union
 
 _logger = logging.getLogger(__name__)
 
+DEFAULT_ARTIFACT_CACHE_DIR = Path.home() / '.brainscore' / 'cache'
+
 
 class UniqueKeyDict(dict):
     def __init__(self, reload=False, **kwargs):
@@ -41,3 +50,113 @@ def get_secret(secret_name: str, region_name: str = 'us-east-2') -> str:
     else:
         _logger.info("Inside binary response...")
         return secret_value_response['SecretBinary']
+
+
+def artifact_cache_preference() -> bool:
+    pref_options = ['yes', 'no']
+    pref = os.getenv('BS_ARTIFACT_CACHE', 'no')
+    assert pref in pref_options, f"BS_ARTIFACT_CACHE value {pref} not recognized. Must be one of {pref_options}."
+    return pref == 'yes'
+
+
+class ArtifactCache:
+    """
+    Pickles loaded models and benchmarks to disk so that subsequent processes can skip loading them from source.
+    Artifacts are keyed by their identifier, the loader, the version of the package defining the loader,
+    and a fingerprint of all python sources in that package (including its model and benchmark plugins),
+    so that updating any plugin code invalidates them.
+    Artifacts that cannot be pickled are returned as-is without caching.
+
+    Weights or data that plugins retrieve from outside the package are not part of the key:
+    if those change under the same identifier, clear the cache with :func:`clear_artifact_cache`.
+    """
+
+    def __init__(self, directory: Union[None, str, Path] = None):
+        """
+        :param directory: where to store artifacts.
+            Defaults to the `BS_ARTIFACT_CACHE_DIR` environment variable, or `~/.brainscore/cache`.
+        """
+        self.directory = Path(directory or os.getenv('BS_ARTIFACT_CACHE_DIR', DEFAULT_ARTIFACT_CACHE_DIR))
+
+    def load(self, loader: Callable[[str], object], identifier: str):
+        path = self.directory / f"{self._key(loader, identifier)}.pkl"
+        if path.is_file():
+            try:
+                with open(path, 'rb') as f:
+                    artifact = pickle.load(f)
+                _logger.debug(f"Loaded {identifier} from cache {path}")
+                return artifact
+            except Exception:
+                _logger.warning(f"Could not load {identifier} from cache {path}, loading from source", exc_info=True)
+        artifact = loader(identifier)
+        self._store(artifact, path)
+        return artifact
+
+    def clear(self):
+        for path in self.directory.glob('*.pkl'):
+            path.unlink()
+
+    def _store(self, artifact, path: Path):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix(f'.{os.getpid()}.tmp')  # write separately so that readers never see partial files
+        try:
+            with open(temp_path, 'wb') as f:
+                pickle.dump(artifact, f)
+            os.replace(temp_path, path)
+        except Exception as e:
+            _logger.warning(f"Could not cache artifact in {path}: {e}")
+            if temp_path.exists():
+                temp_path.unlink()
+
+    @staticmethod
+    def _key(loader: Callable[[str], object], identifier: str) -> str:
+        package = loader.__module__.split('.')[0]
+        key = f"{identifier}|{loader.__module__}.{loader.__qualname__}|{_package_version(package)}|" \
+              f"{_source_fingerprint(loader)}"
+        return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _source_fingerprint(loader: Callable[[str], object]) -> Union[None, str]:
+    """
+    Fingerprint the path, modification time, and size of every python file in the top-level package that defines
+    the `loader`, e.g. all of `brainscore_vision` including its model and benchmark plugins.
+    """
+    package = sys.modules.get(loader.__module__.split('.')[0])
+    package_paths = list(getattr(package, '__path__', None) or [])
+    if package_paths:
+        paths = sorted(Path(package_paths[0]).rglob('*.py'))
+    else:  # loader is not defined in a package, only use its own file
+        try:
+            paths = [Path(inspect.getsourcefile(loader))]
+        except TypeError:  # no source file, e.g. for builtins
+            return None
+    fingerprint = hashlib.sha256()
+    for path in paths:
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        fingerprint.update(f"{path}|{stat.st_mtime_ns}|{stat.st_size}\n".encode())
+    return fingerprint.hexdigest()
+
+
+def _package_version(package: str) -> Union[None, str]:
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:  # python < 3.8
+        return None
+    try:
+        return version(package)
+    except PackageNotFoundError:
+        return None
+
+
+def clear_artifact_cache(directory: Union[None, str, Path] = None):
+    """ Delete all cached artifacts, e.g. `python -m brainscore_core.submission.utils clear_artifact_cache` """
+    ArtifactCache(directory).clear()
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire()
@@ -1,3 +1,4 @@
+import os
 from datetime import datetime
 
 from brainscore_core.submission.database_models import User
@@ -8,3 +9,12 @@ def init_users():
                 last_login=datetime.now(), password='abcde')
     User.create(id=2, email='admin@brainscore.com', is_active=True, is_staff=True, is_superuser=True,
                 last_login=datetime.now(), password='abcdef')
+
+
+def sqlite_test_database() -> str:
+    """
+    A sqlite database file specific to the current pytest-xdist worker (e.g. `sqlite3_gw0.db`)
+    so that tests running in parallel do not clear each other's entries.
+    """
+    worker_id = os.getenv('PYTEST_XDIST_WORKER', 'gw0')
+    return f'sqlite3_{worker_id}.db'
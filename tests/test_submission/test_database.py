@@ -7,9 +7,11 @@ from brainscore_core.benchmarks import BenchmarkBase
 from brainscore_core.submission.database import (connect_db, reference_from_bibtex, benchmarkinstance_from_benchmark,
                                                  submissionentry_from_meta, modelentry_from_model, update_score,
                                                  public_model_identifiers, public_benchmark_identifiers,
-                                                 email_from_uid, uid_from_email)
-from brainscore_core.submission.database_models import Score, BenchmarkType, Reference, clear_schema
-from tests.test_submission import init_users
+                                                 existing_score_entries, seed_score_entries, bulk_update_scores,
+                                                 SCORE_PENDING_COMMENT,
+                                                 email_from_uid, uid_from_email, _cached_reference_from_bibtex)
+from brainscore_core.submission.database_models import Score, BenchmarkType, Reference, clear_schema, database_proxy
+from tests.test_submission import init_users, sqlite_test_database
 
 logger = logging.getLogger(__name__)
 
@@ -31,19 +33,30 @@ SAMPLE_BIBTEX = """@Article{Freeman2013,
 
 
 class SchemaTest:
+    @pytest.fixture(scope='class', autouse=True)
     @classmethod
-    def setup_class(cls):
+    def database(cls):
         logger.info('Connect to database')
-        connect_db(db_secret='sqlite3.db')
+        connect_db(db_secret=sqlite_test_database())
         clear_schema()
-
-    def setup_method(self):
         logger.info('Initialize database entries')
-        init_users()
-
-    def teardown_method(self):
-        logger.info('Clean database')
-        clear_schema()
+        with database_proxy.atomic() as transaction:
+            init_users()
+            yield
+            transaction.rollback()
+
+    @pytest.fixture(autouse=True)
+    def savepoint(self, database):
+        """ run every test inside a savepoint which is rolled back afterwards, leaving only the class-level entries """
+        with database_proxy.atomic() as savepoint:
+            yield
+            savepoint.rollback()
+        _cached_reference_from_bibtex.cache_clear()  # do not hold on to rolled back references
+
+    @pytest.fixture(scope='class')
+    @classmethod
+    def submission_entry(cls, database):
+        return _mock_submission_entry()
 
 
 class TestUser(SchemaTest):
@@ -69,20 +82,18 @@ class TestModel(SchemaTest):
         entry = submissionentry_from_meta(jenkins_id=123, user_id=1, model_type='artificial_subject')
         assert entry.status == 'running'
 
-    def test_model_no_bibtex(self):
-        submission_entry = _mock_submission_entry()
+    def test_model_no_bibtex(self, submission_entry):
         entry = modelentry_from_model(model_identifier='dummy', domain='test',
                                       submission=submission_entry, public=False, competition='cosyne2022')
         assert entry.reference is None
 
-    def test_model_with_bibtex(self):
-        submission_entry = _mock_submission_entry()
+    def test_model_with_bibtex(self, submission_entry):
         entry = modelentry_from_model(model_identifier='dummy', domain='test',
                                       submission=submission_entry, public=True, competition=None, bibtex=SAMPLE_BIBTEX)
         assert entry.reference.year == '2013'
 
-    def test_resubmission(self):  # make model entry from user 1, then retrieve model entry from user 2 ("resubmit")
-        submission_entry = _mock_submission_entry()
+    def test_resubmission(self, submission_entry):
+        # make model entry from user 1, then retrieve model entry from user 2 ("resubmit")
         params = dict(model_identifier='dummy', domain='test', public=True, competition=None, bibtex=SAMPLE_BIBTEX)
         original_entry = modelentry_from_model(**params, submission=submission_entry)
         # resubmit
@@ -124,10 +135,20 @@ class TestBenchmark(SchemaTest):
         assert ref.author is not None
         ref2 = reference_from_bibtex(SAMPLE_BIBTEX)
         assert ref2.id == ref.id
+        assert Reference.select().count() == 1
 
+    def test_reference_cached(self):
+        ref = reference_from_bibtex(SAMPLE_BIBTEX)
+        Reference.delete().execute()  # a second lookup would re-create the entry if it was not cached
+        assert reference_from_bibtex(SAMPLE_BIBTEX) is ref
+        assert Reference.select().count() == 0
 
-def _create_score_entry():
-    submission_entry = submissionentry_from_meta(jenkins_id=123, user_id=1, model_type='brain_model')
+    def test_reference_failure_not_cached(self):
+        assert reference_from_bibtex('not a bibtex string') is None
+        assert _cached_reference_from_bibtex.cache_info().currsize == 0
+
+
+def _create_score_entry(submission_entry):
     model_entry = modelentry_from_model(model_identifier='dummy', domain='test',
                                         submission=submission_entry, public=True, competition=None)
     benchmark_entry = benchmarkinstance_from_benchmark(_MockBenchmark(), domain='test')
@@ -136,69 +157,114 @@ def _create_score_entry():
 
 
 class TestScore(SchemaTest):
-    def test_score_no_ceiling(self):
+    def test_score_no_ceiling(self, submission_entry):
         score = ScoreObject([.123, np.nan], coords={'aggregation': ['center', 'error']}, dims=['aggregation'])
-        entry = _create_score_entry()
+        entry = _create_score_entry(submission_entry)
         update_score(score, entry)
         assert entry.score_ceiled is None
         assert np.isnan(entry.error)
         assert entry.score_raw == .123
 
-    def test_score_with_ceiling(self):
+    def test_score_with_ceiling(self, submission_entry):
         score = ScoreObject([.42, .1], coords={'aggregation': ['center', 'error']}, dims=['aggregation'])
         score.attrs['raw'] = ScoreObject([.336, .08], coords={'aggregation': ['center', 'error']}, dims=['aggregation'])
         score.attrs['ceiling'] = ScoreObject(.8)
-        entry = _create_score_entry()
+        entry = _create_score_entry(submission_entry)
         update_score(score, entry)
         assert entry.score_ceiled == .42
         assert entry.error == .1
         assert entry.score_raw == .336
 
-    def test_score_no_aggregation(self):
+    def test_score_aggregation_order(self, submission_entry):
+        score = ScoreObject([.1, .42], coords={'aggregation': ['error', 'center']}, dims=['aggregation'])
+        entry = _create_score_entry(submission_entry)
+        update_score(score, entry)
+        assert entry.score_raw == .42
+        assert entry.error == .1
+
+    def test_score_no_aggregation(self, submission_entry):
         score = ScoreObject(.42)
-        entry = _create_score_entry()
+        entry = _create_score_entry(submission_entry)
         update_score(score, entry)
         assert entry.score_raw == .42
         assert entry.error is None
 
-    def test_score_error_attr(self):
+    def test_score_error_attr(self, submission_entry):
         score = ScoreObject(.42)
         score.attrs['error'] = .1
-        entry = _create_score_entry()
+        entry = _create_score_entry(submission_entry)
         update_score(score, entry)
         assert entry.error == .1
 
+    def test_score_not_saved(self, submission_entry):
+        score = ScoreObject(.42)
+        entry = _create_score_entry(submission_entry)
+        update_score(score, entry, save=False)
+        assert entry.score_raw == .42
+        assert Score.get_by_id(entry.id).score_raw is None
+
+    def test_bulk_update_scores(self, submission_entry):
+        entry = _create_score_entry(submission_entry)
+        entry.score_raw = .42
+        entry.comment = 'dummy comment'
+        bulk_update_scores([entry])
+        stored_entry = Score.get_by_id(entry.id)
+        assert stored_entry.score_raw == .42
+        assert stored_entry.score_ceiled is None
+        assert stored_entry.comment == 'dummy comment'
+
+    def test_existing_score_entries(self, submission_entry):
+        entry = _create_score_entry(submission_entry)
+        score_entries = existing_score_entries(model_identifiers=['dummy'], benchmark_identifiers=['dummy'])
+        assert list(score_entries.keys()) == [('dummy', entry.benchmark_id)]
+        assert score_entries[('dummy', entry.benchmark_id)].id == entry.id
+
+    def test_existing_score_entries_other_model(self, submission_entry):
+        _create_score_entry(submission_entry)
+        score_entries = existing_score_entries(model_identifiers=['other'], benchmark_identifiers=['dummy'])
+        assert score_entries == {}
+
+    def test_seed_score_entries(self, submission_entry):
+        model_entry = modelentry_from_model(model_identifier='dummy', domain='test',
+                                            submission=submission_entry, public=True, competition=None)
+        benchmark_entry = benchmarkinstance_from_benchmark(_MockBenchmark(), domain='test')
+        seeded_entries = seed_score_entries(model_identifiers=['dummy', 'unknown'], benchmark_entry=benchmark_entry)
+        assert list(seeded_entries.keys()) == [('dummy', benchmark_entry.id)]
+        assert seeded_entries[('dummy', benchmark_entry.id)].model_id == model_entry.id
+        assert seeded_entries[('dummy', benchmark_entry.id)].score_raw is None
+        assert seeded_entries[('dummy', benchmark_entry.id)].comment == SCORE_PENDING_COMMENT
+        # seeding again does not create another entry
+        assert seed_score_entries(model_identifiers=['dummy'], benchmark_entry=benchmark_entry) == {}
+        assert Score.select().count() == 1
+
 
 class TestPublic(SchemaTest):
-    def test_one_public_model(self):
+    def test_one_public_model(self, submission_entry):
         # create model
-        submission_entry = _mock_submission_entry()
         modelentry_from_model(model_identifier='dummy', domain='test',
                               public=True, competition=None, submission=submission_entry)
         # test
         public_models = public_model_identifiers(domain='test')
         assert public_models == ["dummy"]
 
-    def test_one_public_one_private_model(self):
+    def test_one_public_one_private_model(self, submission_entry):
         # create models
-        submission = _mock_submission_entry()
         modelentry_from_model(model_identifier='dummy_public', domain='test',
-                              public=True, competition=None, submission=submission)
+                              public=True, competition=None, submission=submission_entry)
         modelentry_from_model(model_identifier='dummy_private', domain='test',
-                              public=False, competition=None, submission=submission)
+                              public=False, competition=None, submission=submission_entry)
         # test
         public_models = public_model_identifiers(domain='test')
         assert public_models == ["dummy_public"]
 
-    def test_two_public_one_private_model(self):
+    def test_two_public_one_private_model(self, submission_entry):
         # create models
-        submission = _mock_submission_entry()
         modelentry_from_model(model_identifier='dummy_public1', domain='test',
-                              public=True, competition=None, submission=submission)
+                              public=True, competition=None, submission=submission_entry)
         modelentry_from_model(model_identifier='dummy_public2', domain='test',
-                              public=True, competition=None, submission=submission)
+                              public=True, competition=None, submission=submission_entry)
         modelentry_from_model(model_identifier='dummy_private', domain='test',
-                              public=False, competition=None, submission=submission)
+                              public=False, competition=None, submission=submission_entry)
         # test
         public_models = public_model_identifiers(domain='test')
         assert set(public_models) == {"dummy_public1", "dummy_public2"}
@@ -2,19 +2,53 @@ from collections import namedtuple
 
 import botocore.exceptions
 import logging
+import pytest
 
 from brainscore_core import Score, Benchmark
-from brainscore_core.submission import database_models
+from brainscore_core.submission import database_models, endpoints
 from brainscore_core.submission.database import connect_db
 from brainscore_core.submission.database_models import clear_schema
 from brainscore_core.submission.endpoints import RunScoringEndpoint, DomainPlugins, shorten_text
-from tests.test_submission import init_users
+from tests.test_submission import init_users, sqlite_test_database
 
 logger = logging.getLogger(__name__)
 
 POSTGRESQL_TEST_DATABASE = 'brainscore-ohio-test'
 
 
+class _DummyDomainPlugins(DomainPlugins):
+    """ module-level plugins so that they can be sent to worker processes """
+
+    def load_model(self, model_identifier: str):
+        model_class = namedtuple('DummyModel', field_names=[])
+        return model_class()
+
+    def load_benchmark(self, benchmark_identifier: str) -> Benchmark:
+        benchmark_class = namedtuple('DummyBenchmark',
+                                     field_names=['identifier', 'parent', 'version', 'bibtex', 'ceiling'])
+        return benchmark_class(identifier=benchmark_identifier, parent='neural', version=0, bibtex=None,
+                               ceiling=Score(1))
+
+    def score(self, model_identifier: str, benchmark_identifier: str) -> Score:
+        return Score([0.8, 0.1], coords={'aggregation': ['center', 'error']}, dims=['aggregation'])
+
+
+class _CountingDomainPlugins(_DummyDomainPlugins):
+    """ keeps track of all models and benchmarks it loads """
+
+    def __init__(self):
+        self.loaded_models, self.loaded_benchmarks = [], []
+
+    def load_model(self, model_identifier: str):
+        self.loaded_models.append(model_identifier)
+        return super(_CountingDomainPlugins, self).load_model(model_identifier)
+
+    def load_benchmark(self, benchmark_identifier: str) -> Benchmark:
+        self.loaded_benchmarks.append(benchmark_identifier)
+        return super(_CountingDomainPlugins, self).load_benchmark(benchmark_identifier)
+
+
+@pytest.mark.xdist_group(name='postgres')  # all tests share the postgres test database, run them on the same worker
 class TestRunScoring:
     test_database = None
 
@@ -25,8 +59,8 @@ class TestRunScoring:
             connect_db(db_secret=POSTGRESQL_TEST_DATABASE)
             cls.test_database = POSTGRESQL_TEST_DATABASE
         except botocore.exceptions.NoCredentialsError:  # we're in an environment where we cannot retrieve AWS secrets
-            connect_db(db_secret='sqlite3.db')
-            cls.test_database = 'sqlite3.db'  # -> use local sqlite database
+            cls.test_database = sqlite_test_database()  # -> use local sqlite database
+            connect_db(db_secret=cls.test_database)
         clear_schema()
 
     def setup_method(self):
@@ -62,6 +96,134 @@ class TestRunScoring:
         score_entry = score_entries[0]
         assert score_entry.score_raw == 0.8
 
+    def test_2models_2benchmarks_parallel(self):
+        endpoint = RunScoringEndpoint(domain_plugins=_DummyDomainPlugins(), db_secret=self.test_database,
+                                      max_workers=2)
+        endpoint(domain='test', models=['dummymodel1', 'dummymodel2'], benchmarks=['dummybenchmark1', 'dummybenchmark2'],
+                 jenkins_id=123, user_id=1, model_type='artificial_subject', public=True, competition=None)
+        score_entries = list(database_models.Score.select())
+        assert len(score_entries) == 4
+        assert all(score_entry.score_raw == 0.8 for score_entry in score_entries)
+        assert database_models.Model.select().count() == 2
+
+    def test_2models_2benchmarks_loads_once(self):
+        domain_plugins = _CountingDomainPlugins()
+        endpoint = RunScoringEndpoint(domain_plugins=domain_plugins, db_secret=self.test_database, max_workers=1)
+        endpoint(domain='test', models=['dummymodel1', 'dummymodel2'], benchmarks=['dummybenchmark1', 'dummybenchmark2'],
+                 jenkins_id=123, user_id=1, model_type='artificial_subject', public=True, competition=None)
+        score_entries = list(database_models.Score.select())
+        assert len(score_entries) == 4
+        assert all(score_entry.comment is None for score_entry in score_entries)  # no longer marked as pending
+        assert domain_plugins.loaded_models == ['dummymodel1', 'dummymodel2']
+        assert domain_plugins.loaded_benchmarks == ['dummybenchmark1', 'dummybenchmark2']
+
+    def test_loaded_benchmarks_bounded(self):
+        domain_plugins = _CountingDomainPlugins()
+        endpoint = RunScoringEndpoint(domain_plugins=domain_plugins, db_secret=self.test_database)
+        endpoint.MAX_LOADED_BENCHMARKS = 1
+        endpoint(domain='test', models=['dummymodel1', 'dummymodel2', 'dummymodel3'],
+                 benchmarks=['dummybenchmark1', 'dummybenchmark2'],
+                 jenkins_id=123, user_id=1, model_type='artificial_subject', public=True, competition=None)
+        assert len(list(database_models.Score.select())) == 6
+        # only the first benchmark is kept loaded, the second one is re-loaded for every model
+        assert domain_plugins.loaded_benchmarks == ['dummybenchmark1'] + ['dummybenchmark2'] * 3
+
+    def test_2models_2benchmarks_prefetch(self):
+        domain_plugins = _CountingDomainPlugins()
+        endpoint = RunScoringEndpoint(domain_plugins=domain_plugins, db_secret=self.test_database, prefetch_pairs=1)
+        endpoint(domain='test', models=['dummymodel1', 'dummymodel2'],
+                 benchmarks=['dummybenchmark1', 'dummybenchmark2'],
+                 jenkins_id=123, user_id=1, model_type='artificial_subject', public=True, competition=None)
+        score_entries = list(database_models.Score.select())
+        assert len(score_entries) == 4
+        assert all(score_entry.score_raw == 0.8 for score_entry in score_entries)
+        assert domain_plugins.loaded_models == ['dummymodel1', 'dummymodel2']
+
+    def test_scores_stored_when_model_changes(self):
+        stored_scores = []
+
+        class RecordingDomainPlugins(_DummyDomainPlugins):
+            def score(self, model_identifier: str, benchmark_identifier: str) -> Score:
+                stored_scores.append(database_models.Score.select()
+                                     .where(database_models.Score.score_raw.is_null(False)).count())
+                return super(RecordingDomainPlugins, self).score(model_identifier, benchmark_identifier)
+
+        endpoint = RunScoringEndpoint(domain_plugins=RecordingDomainPlugins(), db_secret=self.test_database)
+        endpoint(domain='test', models=['dummymodel1', 'dummymodel2'], benchmarks=['dummybenchmark'],
+                 jenkins_id=123, user_id=1, model_type='artificial_subject', public=True, competition=None)
+        assert stored_scores == [0, 1]  # score of the first model is written before the second model is scored
+
+    def test_status_stored_when_storing_scores_fails(self, monkeypatch):
+        def failing_bulk_update_scores(entries):
+            raise ValueError('dummy database failure')
+
+        monkeypatch.setattr(endpoints, 'bulk_update_scores', failing_bulk_update_scores)
+        endpoint = RunScoringEndpoint(domain_plugins=_DummyDomainPlugins(), db_secret=self.test_database)
+        endpoint(domain='test', models=['dummymodel'], benchmarks=['dummybenchmark'],
+                 jenkins_id=123, user_id=1, model_type='artificial_subject', public=True, competition=None)
+        assert database_models.Submission.get().status == 'failure'
+
+    def test_public_models_cached(self, monkeypatch):
+        queried_domains = []
+
+        def counting_public_model_identifiers(domain):
+            queried_domains.append(domain)
+            return ['dummymodel']
+
+        monkeypatch.setattr(endpoints, 'public_model_identifiers', counting_public_model_identifiers)
+        RunScoringEndpoint.refresh_public_lists()
+        domain_plugins = _CountingDomainPlugins()
+        endpoint = RunScoringEndpoint(domain_plugins=domain_plugins, db_secret=self.test_database)
+        endpoint.PUBLIC_IDENTIFIERS_TTL = 60 * 60  # make sure both calls fall into the same time bucket
+        for jenkins_id in [123, 124]:
+            endpoint(domain='test', models=RunScoringEndpoint.ALL_PUBLIC, benchmarks=['dummybenchmark'],
+                     jenkins_id=jenkins_id, user_id=1, model_type='artificial_subject', public=True,
+                     competition=None)
+        assert queried_domains == ['test']
+        assert domain_plugins.loaded_models == ['dummymodel']  # second call finds the existing score
+
+    def test_refresh_public_lists(self, monkeypatch):
+        queried_domains = []
+
+        def counting_public_model_identifiers(domain):
+            queried_domains.append(domain)
+            return []
+
+        monkeypatch.setattr(endpoints, 'public_model_identifiers', counting_public_model_identifiers)
+        RunScoringEndpoint.refresh_public_lists()
+        endpoint = RunScoringEndpoint(domain_plugins=_DummyDomainPlugins(), db_secret=self.test_database)
+        endpoint.PUBLIC_IDENTIFIERS_TTL = 60 * 60  # make sure both calls fall into the same time bucket
+        for jenkins_id in [123, 124]:
+            endpoint(domain='test', models=RunScoringEndpoint.ALL_PUBLIC, benchmarks=['dummybenchmark'],
+                     jenkins_id=jenkins_id, user_id=1, model_type='artificial_subject', public=True,
+                     competition=None)
+            RunScoringEndpoint.refresh_public_lists()
+        assert queried_domains == ['test', 'test']
+
+    def test_already_scored_does_not_load_model(self):
+        run_kwargs = dict(domain='test', models=['dummymodel'], benchmarks=['dummybenchmark'],
+                          user_id=1, model_type='artificial_subject', public=True, competition=None)
+        RunScoringEndpoint(domain_plugins=_DummyDomainPlugins(), db_secret=self.test_database)(
+            jenkins_id=123, **run_kwargs)
+        domain_plugins = _CountingDomainPlugins()
+        RunScoringEndpoint(domain_plugins=domain_plugins, db_secret=self.test_database)(jenkins_id=124, **run_kwargs)
+        assert len(list(database_models.Score.select())) == 1
+        assert domain_plugins.loaded_models == []
+
+    def test_failure_stored_in_comment(self):
+        class FailingDomainPlugins(_DummyDomainPlugins):
+            def score(self, model_identifier: str, benchmark_identifier: str) -> Score:
+                raise ValueError('dummy failure')
+
+        endpoint = RunScoringEndpoint(domain_plugins=FailingDomainPlugins(), db_secret=self.test_database)
+        endpoint(domain='test', models=['dummymodel'], benchmarks=['dummybenchmark'],
+                 jenkins_id=123, user_id=1, model_type='artificial_subject', public=True, competition=None)
+        score_entry = database_models.Score.get()
+        assert score_entry.score_raw is None
+        assert score_entry.comment.count('dummy failure') == 1
+        assert 'Traceback' not in score_entry.comment  # full stack is only stored in debug mode
+        assert database_models.Submission.get().status == 'failure'
+
 
 class TestShortenText:
     def test_text_short_enough(self):
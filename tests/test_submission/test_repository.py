@@ -7,7 +7,7 @@ from pathlib import Path
 from brainscore_core.submission.database import connect_db
 from brainscore_core.submission.database_models import clear_schema
 from brainscore_core.submission.repository import extract_zip_file, find_submission_directory
-from tests.test_submission import init_users
+from tests.test_submission import init_users, sqlite_test_database
 
 logger = logging.getLogger(__name__)
 
@@ -19,7 +19,7 @@ class TestRepository:
 
     @classmethod
     def setup_class(cls):
-        connect_db(db_secret='sqlite3.db')
+        connect_db(db_secret=sqlite_test_database())
         clear_schema()
         init_users()
 
@@ -0,0 +1,62 @@
+import importlib
+
+from brainscore_core.submission.utils import ArtifactCache
+
+
+class _DummyLoader:
+    def __init__(self):
+        self.loaded = []
+
+    def load_model(self, model_identifier: str):
+        self.loaded.append(model_identifier)
+        return {'identifier': model_identifier}
+
+    def load_unpicklable(self, identifier: str):
+        self.loaded.append(identifier)
+        return lambda: identifier
+
+
+class TestArtifactCache:
+    def test_load_once(self, tmp_path):
+        loader = _DummyLoader()
+        ArtifactCache(tmp_path).load(loader.load_model, 'dummy')
+        artifact = ArtifactCache(tmp_path).load(loader.load_model, 'dummy')
+        assert artifact == {'identifier': 'dummy'}
+        assert loader.loaded == ['dummy']
+
+    def test_unpicklable(self, tmp_path):
+        loader = _DummyLoader()
+        cache = ArtifactCache(tmp_path)
+        artifact = cache.load(loader.load_unpicklable, 'dummy')
+        assert artifact() == 'dummy'
+        cache.load(loader.load_unpicklable, 'dummy')
+        assert loader.loaded == ['dummy', 'dummy']
+        assert not list(tmp_path.iterdir())
+
+    def test_clear(self, tmp_path):
+        loader = _DummyLoader()
+        cache = ArtifactCache(tmp_path)
+        cache.load(loader.load_model, 'dummy')
+        cache.clear()
+        cache.load(loader.load_model, 'dummy')
+        assert loader.loaded == ['dummy', 'dummy']
+
+    def test_plugin_change_invalidates(self, tmp_path, monkeypatch):
+        package = tmp_path / 'dummy_domain'
+        plugin_directory = package / 'models' / 'dummymodel'
+        plugin_directory.mkdir(parents=True)
+        (package / '__init__.py').write_text("loaded = []\n\n"
+                                             "def load_model(identifier):\n"
+                                             "    loaded.append(identifier)\n"
+                                             "    return {'identifier': identifier}\n")
+        plugin_file = plugin_directory / 'model.py'
+        plugin_file.write_text('version = 1\n')
+        monkeypatch.syspath_prepend(str(tmp_path))
+        domain = importlib.import_module('dummy_domain')
+        cache = ArtifactCache(tmp_path / 'cache')
+        cache.load(domain.load_model, 'dummymodel')
+        cache.load(domain.load_model, 'dummymodel')
+        assert domain.loaded == ['dummymodel']
+        plugin_file.write_text('version = 10\n')  # plugin code changes, but the domain library does not
+        cache.load(domain.load_model, 'dummymodel')
+        assert domain.loaded == ['dummymodel', 'dummymodel']